@@ -3,14 +3,20 @@ from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 import os
+import sys
+import json
+import math
 import subprocess
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
 from dotenv import load_dotenv
 import jwt
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from functools import wraps
+from collections import Counter, OrderedDict
 
 load_dotenv()
 
@@ -24,13 +30,23 @@ CORS(app, resources={
     }
 })
 
+# Number of reverse proxies in front of the app (e.g. 1 on Render/Heroku). Only
+# that many X-Forwarded-For entries are trusted when working out the client IP.
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 # HLS output directory
 HLS_OUTPUT_DIR = Path('hls_output')
 HLS_OUTPUT_DIR.mkdir(exist_ok=True)
 
+# Request threads available to Flask (a2wsgi pool size when served by asgi.py)
+FLASK_WORKERS = int(os.getenv('FLASK_WORKERS', '10'))
+
 # Store active FFmpeg processes
 active_streams = {}
-stream_lock = threading.Lock()
+# Re-entrant: get_hls_playlist holds it while start_ffmpeg_stream registers the process
+stream_lock = threading.RLock()
 
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
@@ -47,6 +63,63 @@ JWT_SECRET_KEY = app.config['SECRET_KEY']
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_DELTA = timedelta(days=7)
 
+# Password Hashing Configuration
+# Method string as accepted by werkzeug's generate_password_hash,
+# e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_HASH_SALT_LENGTH = int(os.getenv('PASSWORD_HASH_SALT_LENGTH', '16'))
+# Hashing is deliberately slow, so it runs on a small dedicated pool, and
+# requests beyond the queue limit are rejected with 503. The waiting request
+# thread is still occupied, so workers + queue limit must stay well below
+# FLASK_WORKERS or a login burst can park every request thread; by default
+# they take at most half of them.
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv(
+    'PASSWORD_HASH_QUEUE_LIMIT',
+    str(max(0, FLASK_WORKERS // 2 - PASSWORD_HASH_WORKERS))
+))
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))
+
+password_hash_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS,
+    thread_name_prefix='password-hash'
+)
+password_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_LIMIT)
+
+class PasswordHashBusy(Exception):
+    """Raised when the password hashing pool is saturated"""
+    retry_after = 1
+
+def run_password_hash(func, *args, **kwargs):
+    """Run a password hash function on the bounded hashing pool"""
+    if not password_hash_slots.acquire(blocking=False):
+        raise PasswordHashBusy()
+    try:
+        future = password_hash_executor.submit(func, *args, **kwargs)
+    except Exception:
+        password_hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: password_hash_slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        raise PasswordHashBusy()
+
+def password_hash_params(password_hash):
+    """Return the method prefix of a werkzeug hash, e.g. 'scrypt:32768:8:1'"""
+    return password_hash.split('$', 1)[0] if password_hash else ''
+
+# werkzeug expands bare method names ('scrypt', 'pbkdf2') with its own defaults,
+# so derive the prefix stored hashes will carry from a real hash at startup
+CURRENT_PASSWORD_HASH_PARAMS = password_hash_params(
+    generate_password_hash('', method=PASSWORD_HASH_METHOD, salt_length=PASSWORD_HASH_SALT_LENGTH)
+)
+
+def password_hash_busy_response():
+    return jsonify({'error': 'Server is busy, please try again shortly'}), 503, {
+        'Retry-After': str(PasswordHashBusy.retry_after)
+    }
+
 # User Model
 class User(db.Model):
     __tablename__ = 'users'
@@ -58,10 +131,23 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = run_password_hash(
+            generate_password_hash,
+            password,
+            method=PASSWORD_HASH_METHOD,
+            salt_length=PASSWORD_HASH_SALT_LENGTH
+        )
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return run_password_hash(check_password_hash, self.password_hash, password)
+    
+    def needs_rehash(self):
+        """True if the stored hash was made with different hash parameters or salt length"""
+        if password_hash_params(self.password_hash) != CURRENT_PASSWORD_HASH_PARAMS:
+            return True
+        # Stored as 'method$salt$hash'
+        parts = self.password_hash.split('$')
+        return len(parts) != 3 or len(parts[1]) != PASSWORD_HASH_SALT_LENGTH
     
     def to_dict(self):
         return {
@@ -108,6 +194,7 @@ class StreamSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, unique=True, index=True)
     rtsp_url = db.Column(db.String(500), nullable=False)
+    source_probe = db.Column(db.JSON, nullable=True)  # ffprobe result of an rtsp:// URL
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -117,6 +204,7 @@ class StreamSettings(db.Model):
         return {
             'id': self.id,
             'rtsp_url': self.rtsp_url,
+            'source': self.source_probe,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
@@ -134,43 +222,188 @@ def generate_token(user_id):
     }
     return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
 
+# Decoded tokens are cached so playlist and segment polls skip signature checks
+TOKEN_CACHE_SIZE = 10000
+token_cache = {}
+
 def decode_token(token):
+    payload = token_cache.get(token)
+    if payload and payload['exp'] > time.time():
+        return payload
     try:
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    if len(token_cache) >= TOKEN_CACHE_SIZE:
+        token_cache.clear()
+    token_cache[token] = payload
+    return payload
+
+def parse_auth_header(auth_header):
+    """Return (user_id, None) or (None, error message) for an Authorization header"""
+    token = None
+    if auth_header is not None:
+        try:
+            token = auth_header.split(' ')[1]  # Bearer <token>
+        except IndexError:
+            return None, 'Invalid token format'
+    
+    if not token:
+        return None, 'Token is missing'
+    
+    payload = decode_token(token)
+    if not payload:
+        return None, 'Invalid or expired token'
+    
+    return payload['user_id'], None
 
 # Authentication Decorator
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            try:
-                token = auth_header.split(' ')[1]  # Bearer <token>
-            except IndexError:
-                return jsonify({'error': 'Invalid token format'}), 401
-        
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-        
-        payload = decode_token(token)
-        if not payload:
-            return jsonify({'error': 'Invalid or expired token'}), 401
+        current_user_id, error = parse_auth_header(request.headers.get('Authorization'))
+        if error:
+            return jsonify({'error': error}), 401
         
-        current_user_id = payload['user_id']
         return f(current_user_id, *args, **kwargs)
     
     return decorated
 
+# Admin Decorator
+def admin_required(f):
+    """Require the X-Admin-Secret header to match ADMIN_SECRET (disabled if unset)"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        admin_secret = os.getenv('ADMIN_SECRET')
+        if not admin_secret:
+            return jsonify({'error': 'Admin endpoints are disabled'}), 403
+        if request.headers.get('X-Admin-Secret') != admin_secret:
+            return jsonify({'error': 'Invalid admin secret'}), 401
+        return f(*args, **kwargs)
+    
+    return decorated
+
+# Rate Limiting
+# Each limit is "<burst>/<seconds>": a token bucket holding <burst> tokens that
+# refills completely over <seconds>. Buckets are keyed by route class and user
+# (or client IP for the unauthenticated auth routes).
+RATE_LIMITS = {
+    'auth': os.getenv('RATE_LIMIT_AUTH', '10/60'),
+    'stream_start': os.getenv('RATE_LIMIT_STREAM_START', '3/60'),
+    'probe': os.getenv('RATE_LIMIT_PROBE', '5/60'),
+}
+
+def parse_rate_limit(spec):
+    """Parse '<burst>/<seconds>' into (capacity, tokens per second)"""
+    burst, seconds = spec.split('/')
+    capacity = float(burst)
+    return capacity, capacity / float(seconds)
+
+RATE_LIMITS = {route_class: parse_rate_limit(spec) for route_class, spec in RATE_LIMITS.items()}
+
+class MemoryBucketBackend:
+    """Token buckets held in this process (limits are per worker)"""
+    
+    def __init__(self, max_keys=10000):
+        self.buckets = OrderedDict()  # least recently used first
+        self.lock = threading.Lock()
+        self.max_keys = max_keys
+    
+    def take(self, key, capacity, refill_rate):
+        """Take one token; return 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / refill_rate
+
+class RedisBucketBackend:
+    """Token buckets shared between workers through Redis (requires `pip install redis`)"""
+    
+    # Refill and take atomically, using the Redis clock so workers agree on time
+    SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or capacity
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+        redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+        return tostring(wait)
+    """
+    
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.script = self.client.register_script(self.SCRIPT)
+    
+    def take(self, key, capacity, refill_rate):
+        return float(self.script(keys=[f'ratelimit:{key}'], args=[capacity, refill_rate]))
+
+def create_rate_limit_backend():
+    redis_url = os.getenv('RATE_LIMIT_REDIS_URL')
+    if redis_url:
+        return RedisBucketBackend(redis_url)
+    return MemoryBucketBackend()
+
+rate_limit_backend = create_rate_limit_backend()
+
+def take_rate_limit_token(route_class, key):
+    """Take a token from a bucket; return 0 if allowed, else seconds to wait"""
+    capacity, refill_rate = RATE_LIMITS[route_class]
+    try:
+        return rate_limit_backend.take(f'{route_class}:{key}', capacity, refill_rate)
+    except Exception as e:
+        # Fail open: an unavailable shared backend must not take the API down
+        print(f"Rate limit backend error: {e}")
+        return 0
+
+def rate_limit_response(retry_after):
+    return jsonify({'error': 'Too many requests, please slow down'}), 429, {
+        'Retry-After': str(max(1, math.ceil(retry_after)))
+    }
+
+# Rate Limit Decorator
+def rate_limited(route_class):
+    """Throttle a route per user, or per client IP when there is no user yet.
+    
+    Place below @token_required so the current user id is available.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            # remote_addr honours X-Forwarded-For only for TRUSTED_PROXY_HOPS
+            key = args[0] if args else request.remote_addr
+            retry_after = take_rate_limit_token(route_class, key)
+            if retry_after > 0:
+                return rate_limit_response(retry_after)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
 # API Routes
 
 # Authentication Routes
 @app.route('/api/auth/register', methods=['POST'])
+@rate_limited('auth')
 def register():
     data = request.get_json()
     
@@ -189,7 +422,10 @@ def register():
         username=data['username'],
         email=data['email']
     )
-    user.set_password(data['password'])
+    try:
+        user.set_password(data['password'])
+    except PasswordHashBusy:
+        return password_hash_busy_response()
     
     db.session.add(user)
     db.session.commit()
@@ -203,6 +439,7 @@ def register():
     }), 201
 
 @app.route('/api/auth/login', methods=['POST'])
+@rate_limited('auth')
 def login():
     data = request.get_json()
     
@@ -211,8 +448,20 @@ def login():
     
     user = User.query.filter_by(username=data['username']).first()
     
-    if not user or not user.check_password(data['password']):
-        return jsonify({'error': 'Invalid username or password'}), 401
+    try:
+        if not user or not user.check_password(data['password']):
+            return jsonify({'error': 'Invalid username or password'}), 401
+    except PasswordHashBusy:
+        return password_hash_busy_response()
+    
+    # Transparently upgrade hashes made with old parameters; if the pool is
+    # busy the upgrade is simply retried on a later login
+    if user.needs_rehash():
+        try:
+            user.set_password(data['password'])
+            db.session.commit()
+        except PasswordHashBusy:
+            pass
     
     # Generate token
     token = generate_token(user.id)
@@ -230,144 +479,44 @@ def get_current_user(current_user_id):
         return jsonify({'error': 'User not found'}), 404
     return jsonify(user.to_dict()), 200
 
-# Database Migration Endpoint (One-time use)
+# Database Migration Endpoint
 @app.route('/api/migrate', methods=['POST'])
 def run_migration():
     """
-    One-time migration endpoint to add user_id columns to existing tables.
-    Can be called multiple times safely (idempotent).
+    Apply pending database migrations (see migrate_db.py).
+    Safe to call repeatedly: completed migrations are skipped and an
+    interrupted run resumes from its checkpoint.
+    Optional JSON body: {"dry_run": true} to get timing estimates instead,
+    {"max_seconds": 20} to stop early (call again to continue).
     Optional: Add MIGRATION_SECRET in env for security.
     """
-    from sqlalchemy import text
+    from migrate_db import run_migrations
+    
+    data = request.get_json(silent=True) or {}
     
     # Optional security check
     migration_secret = os.getenv('MIGRATION_SECRET')
     if migration_secret:
-        provided_secret = request.headers.get('X-Migration-Secret') or request.json.get('secret') if request.is_json else None
+        provided_secret = request.headers.get('X-Migration-Secret') or data.get('secret')
         if provided_secret != migration_secret:
             return jsonify({'error': 'Invalid migration secret'}), 401
     
-    results = {
-        'success': True,
-        'steps': [],
-        'errors': []
-    }
+    # Stay well inside the server's request timeout; resume with another call
+    try:
+        max_seconds = float(data.get('max_seconds', os.getenv('MIGRATION_REQUEST_SECONDS', '20')))
+    except (TypeError, ValueError):
+        max_seconds = None
+    if max_seconds is None or not math.isfinite(max_seconds) or max_seconds <= 0:
+        return jsonify({'error': 'max_seconds must be a positive number'}), 400
     
     try:
-        # Create users table if it doesn't exist
-        db.create_all()
-        results['steps'].append('Users table created/verified')
-        
-        # Check if user_id column exists in overlays table
-        try:
-            result = db.session.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='overlays' AND column_name='user_id'
-            """))
-            overlay_has_user_id = result.fetchone() is not None
-        except Exception as e:
-            overlay_has_user_id = False
-            results['errors'].append(f"Error checking overlays: {str(e)}")
-        
-        # Check if user_id column exists in stream_settings table
-        try:
-            result = db.session.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='stream_settings' AND column_name='user_id'
-            """))
-            settings_has_user_id = result.fetchone() is not None
-        except Exception as e:
-            settings_has_user_id = False
-            results['errors'].append(f"Error checking stream_settings: {str(e)}")
-        
-        # Add user_id to overlays if it doesn't exist
-        if not overlay_has_user_id:
-            try:
-                db.session.execute(text("""
-                    ALTER TABLE overlays 
-                    ADD COLUMN user_id INTEGER REFERENCES users(id)
-                """))
-                db.session.commit()
-                results['steps'].append('Added user_id column to overlays table')
-            except Exception as e:
-                results['errors'].append(f"Error adding user_id to overlays: {str(e)}")
-                db.session.rollback()
-        else:
-            results['steps'].append('overlays table already has user_id column')
-        
-        # Add user_id to stream_settings if it doesn't exist
-        if not settings_has_user_id:
-            try:
-                # First add as nullable
-                db.session.execute(text("""
-                    ALTER TABLE stream_settings 
-                    ADD COLUMN user_id INTEGER REFERENCES users(id)
-                """))
-                db.session.commit()
-                results['steps'].append('Added user_id column to stream_settings table')
-                
-                # Delete existing stream_settings that don't have user_id
-                result = db.session.execute(text("""
-                    DELETE FROM stream_settings WHERE user_id IS NULL
-                """))
-                db.session.commit()
-                deleted_count = result.rowcount
-                if deleted_count > 0:
-                    results['steps'].append(f'Cleaned up {deleted_count} orphaned stream_settings')
-                
-                # Now make it NOT NULL and UNIQUE
-                db.session.execute(text("""
-                    ALTER TABLE stream_settings 
-                    ALTER COLUMN user_id SET NOT NULL
-                """))
-                db.session.execute(text("""
-                    ALTER TABLE stream_settings 
-                    ADD CONSTRAINT stream_settings_user_id_unique UNIQUE (user_id)
-                """))
-                db.session.commit()
-                results['steps'].append('Made user_id NOT NULL and UNIQUE in stream_settings')
-            except Exception as e:
-                results['errors'].append(f"Error adding user_id to stream_settings: {str(e)}")
-                db.session.rollback()
-        else:
-            results['steps'].append('stream_settings table already has user_id column')
-        
-        # Clean up overlays without user_id
-        try:
-            result = db.session.execute(text("""
-                DELETE FROM overlays WHERE user_id IS NULL
-            """))
-            db.session.commit()
-            deleted_count = result.rowcount
-            if deleted_count > 0:
-                results['steps'].append(f'Cleaned up {deleted_count} orphaned overlays')
-        except Exception as e:
-            results['errors'].append(f"Could not clean up overlays: {str(e)}")
-        
-        # Make user_id NOT NULL in overlays if it's nullable
-        try:
-            db.session.execute(text("""
-                ALTER TABLE overlays 
-                ALTER COLUMN user_id SET NOT NULL
-            """))
-            db.session.commit()
-            results['steps'].append('Made user_id NOT NULL in overlays')
-        except Exception as e:
-            # Column might already be NOT NULL or have NULL values
-            results['errors'].append(f"Could not set user_id to NOT NULL in overlays: {str(e)}")
-            db.session.rollback()
-        
-        if results['errors']:
-            results['success'] = False
-        
-        return jsonify(results), 200 if results['success'] else 500
-        
+        results = run_migrations(db, dry_run=bool(data.get('dry_run')), max_seconds=max_seconds)
     except Exception as e:
-        results['success'] = False
-        results['errors'].append(f"Migration failed: {str(e)}")
-        return jsonify(results), 500
+        return jsonify({'success': False, 'steps': [], 'errors': [f"Migration failed: {str(e)}"]}), 500
+    
+    if results.get('already_running'):
+        return jsonify(results), 409
+    return jsonify(results), 200 if results['success'] else 500
 
 # Stream Settings Routes
 @app.route('/api/stream/settings', methods=['GET'])
@@ -380,18 +529,37 @@ def get_stream_settings(current_user_id):
 
 @app.route('/api/stream/settings', methods=['POST', 'PUT'])
 @token_required
+@rate_limited('probe')
 def update_stream_settings(current_user_id):
     data = request.get_json()
-    settings = StreamSettings.query.filter_by(user_id=current_user_id).first()
     
+    # Probe RTSP sources now so a broken URL fails here rather than at first play.
+    # This runs before any query so no transaction is held open while waiting.
+    # Other URLs (MP4, HLS, DASH over http(s)) are played directly by the browser.
+    rtsp_url = data.get('rtsp_url')
+    probe = None
+    if rtsp_url and rtsp_url.startswith('rtsp://'):
+        try:
+            probe = probe_rtsp_source(rtsp_url)
+        except ProbeBusy:
+            return jsonify({'error': 'Server is busy, please try again shortly'}), 503, {
+                'Retry-After': str(ProbeBusy.retry_after)
+            }
+        if probe is not None and not probe['reachable']:
+            return jsonify({'error': f"Could not open RTSP stream: {probe['error']}"}), 400
+    
+    settings = StreamSettings.query.filter_by(user_id=current_user_id).first()
     if not settings:
         settings = StreamSettings(user_id=current_user_id, rtsp_url=data.get('rtsp_url', ''))
         db.session.add(settings)
     else:
         settings.rtsp_url = data.get('rtsp_url', settings.rtsp_url)
         settings.updated_at = datetime.utcnow()
+    if 'rtsp_url' in data:
+        settings.source_probe = probe
     
     db.session.commit()
+    invalidate_stream_cache(settings.id)
     return jsonify(settings.to_dict())
 
 # Overlay CRUD Routes
@@ -452,21 +620,198 @@ def delete_overlay(current_user_id, overlay_id):
     return jsonify({'message': 'Overlay deleted successfully'}), 200
 
 # RTSP to HLS Conversion Routes
-def start_ffmpeg_stream(rtsp_url, stream_id):
-    """Start FFmpeg process to convert RTSP to HLS"""
-    playlist_path = HLS_OUTPUT_DIR / f'stream_{stream_id}.m3u8'
+# These helpers are shared with the async media-serving path in asgi.py
+
+PLAYLIST_HEADERS = {
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+    'Access-Control-Allow-Origin': '*',
+    'Content-Type': 'application/vnd.apple.mpegurl'
+}
+
+SEGMENT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Cache-Control': 'public, max-age=3600'
+}
+
+# Stream ownership cache: (user_id, stream_id) -> (rtsp_url, expires_at).
+# Every playlist and segment request checks ownership, so this keeps those
+# polls off the database. The cache is per process: saving settings only
+# invalidates it in the worker that handled the save, and other workers keep
+# the old rtsp_url for up to STREAM_CACHE_TTL seconds.
+STREAM_CACHE_TTL = float(os.getenv('STREAM_CACHE_TTL', '30'))
+stream_cache = {}
+
+def cached_stream_url(user_id, stream_id):
+    """Return the cached RTSP URL of a stream owned by the user, or None on a miss"""
+    cached = stream_cache.get((user_id, stream_id))
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+def get_owned_stream_url(user_id, stream_id):
+    """Return the RTSP URL of a stream owned by the user, or None (needs an app context)"""
+    cached = cached_stream_url(user_id, stream_id)
+    if cached is not None:
+        return cached
+    settings = StreamSettings.query.filter_by(id=stream_id, user_id=user_id).first()
+    if not settings:
+        return None
+    stream_cache[(user_id, stream_id)] = (settings.rtsp_url, time.monotonic() + STREAM_CACHE_TTL)
+    return settings.rtsp_url
+
+def invalidate_stream_cache(stream_id):
+    # Snapshot the keys: other threads insert while we iterate
+    for key in [key for key in list(stream_cache) if key[1] == stream_id]:
+        stream_cache.pop(key, None)
+
+def playlist_path_for(stream_id):
+    return HLS_OUTPUT_DIR / f'stream_{stream_id}.m3u8'
+
+def segment_path_for(stream_id, filename):
+    """Return the path of a stream's segment file, or None if the name is not one"""
+    if not filename.startswith(f'stream_{stream_id}_') or not filename.endswith('.ts') or '/' in filename:
+        return None
+    return HLS_OUTPUT_DIR / filename
+
+def rewrite_playlist(content, stream_id):
+    """Fix segment URLs in a playlist to use absolute API paths"""
+    lines = content.split('\n')
+    fixed_lines = []
+    for line in lines:
+        if line.endswith('.ts') and not line.startswith('http'):
+            # Make segment URL absolute
+            fixed_lines.append(f'/api/stream/hls/{stream_id}/{line}')
+        else:
+            fixed_lines.append(line)
+    
+    return '\n'.join(fixed_lines)
+
+# RTSP Source Probing
+# RTSP sources are probed with ffprobe when stream settings are saved. The
+# result is stored with the settings and lets FFmpeg skip its own (slow) stream
+# detection and copy codecs browsers can already play instead of re-encoding them.
+RTSP_PROBE_TIMEOUT = float(os.getenv('RTSP_PROBE_TIMEOUT', '8'))
+# A probe holds its request thread for up to RTSP_PROBE_TIMEOUT, so only a few
+# may run at once; further saves get a 503 instead of exhausting FLASK_WORKERS
+RTSP_PROBE_CONCURRENCY = int(os.getenv('RTSP_PROBE_CONCURRENCY', '2'))
+probe_slots = threading.BoundedSemaphore(RTSP_PROBE_CONCURRENCY)
+# Only 8-bit 4:2:0 H.264 plays everywhere; 10-bit or 4:2:2 sources are transcoded
+PASSTHROUGH_VIDEO_CODECS = {'h264'}
+PASSTHROUGH_PIXEL_FORMATS = {'yuv420p'}
+PASSTHROUGH_AUDIO_CODECS = {'aac'}
+# Input detection limits used when the source has already been probed
+# (FFmpeg defaults are 5 seconds / 5 MB)
+PROBED_ANALYZEDURATION = '1000000'  # microseconds
+PROBED_PROBESIZE = '1000000'  # bytes
+
+def parse_frame_rate(rate):
+    """Convert an ffprobe rate such as '30000/1001' to frames per second"""
+    try:
+        num, den = rate.split('/')
+        return round(float(num) / float(den), 2) if float(den) else None
+    except (AttributeError, ValueError):
+        return None
+
+class ProbeBusy(Exception):
+    """Raised when RTSP_PROBE_CONCURRENCY probes are already running"""
+    retry_after = 5
+
+def probe_rtsp_source(rtsp_url):
+    """Probe an RTSP source with ffprobe.
+    
+    Returns a dict with 'reachable' plus codec details (or 'error'), or None
+    if ffprobe is not installed and the source cannot be checked. Raises
+    ProbeBusy if too many probes are already running.
+    """
+    probe_cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-rtsp_transport', 'tcp',
+        '-print_format', 'json',
+        '-show_streams',
+        rtsp_url
+    ]
+    
+    if not probe_slots.acquire(blocking=False):
+        raise ProbeBusy()
+    try:
+        process = subprocess.run(
+            probe_cmd,
+            capture_output=True,
+            stdin=subprocess.DEVNULL,
+            timeout=RTSP_PROBE_TIMEOUT
+        )
+    except FileNotFoundError:
+        print("ffprobe not found, skipping RTSP source probe")
+        return None
+    except subprocess.TimeoutExpired:
+        return {'reachable': False, 'error': f'No response within {RTSP_PROBE_TIMEOUT:g} seconds'}
+    finally:
+        probe_slots.release()
+    
+    if process.returncode != 0:
+        error = process.stderr.decode(errors='replace').strip().splitlines()
+        return {'reachable': False, 'error': error[-1] if error else f'ffprobe exited with code {process.returncode}'}
+    
+    try:
+        streams = json.loads(process.stdout).get('streams', [])
+    except ValueError:
+        return {'reachable': False, 'error': 'Unreadable ffprobe output'}
+    
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    if not video:
+        return {'reachable': False, 'error': 'No video stream found'}
+    
+    result = {
+        'reachable': True,
+        'video_codec': video.get('codec_name'),
+        'profile': video.get('profile'),
+        'pix_fmt': video.get('pix_fmt'),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'fps': parse_frame_rate(video.get('avg_frame_rate')) or parse_frame_rate(video.get('r_frame_rate')),
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'probed_at': time.time()
+    }
+    return result
+
+def get_stream_probe(stream_id):
+    """Return the stored probe result of a stream, or None (needs an app context)"""
+    settings = db.session.get(StreamSettings, stream_id)
+    return settings.source_probe if settings else None
+
+def build_ffmpeg_command(rtsp_url, stream_id, probe=None):
+    """Build the FFmpeg command to convert RTSP to HLS, tuned by a stored probe result"""
+    playlist_path = playlist_path_for(stream_id)
     segment_path = HLS_OUTPUT_DIR / f'stream_{stream_id}_%03d.ts'
     
-    # FFmpeg command to convert RTSP to HLS
-    ffmpeg_cmd = [
+    input_args = ['-rtsp_transport', 'tcp']  # Use TCP for better reliability
+    if probe:
+        input_args += ['-analyzeduration', PROBED_ANALYZEDURATION, '-probesize', PROBED_PROBESIZE]
+    
+    if (probe and probe['video_codec'] in PASSTHROUGH_VIDEO_CODECS
+            and probe.get('pix_fmt') in PASSTHROUGH_PIXEL_FORMATS):
+        video_args = ['-c:v', 'copy']
+    else:
+        # Force 8-bit 4:2:0 so 10-bit or 4:2:2 sources come out browser-playable
+        video_args = ['-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'zerolatency', '-pix_fmt', 'yuv420p']
+    
+    if probe and not probe['audio_codec']:
+        audio_args = ['-an']
+    elif probe and probe['audio_codec'] in PASSTHROUGH_AUDIO_CODECS:
+        audio_args = ['-c:a', 'copy']
+    else:
+        audio_args = ['-c:a', 'aac', '-b:a', '128k']
+    
+    return [
         'ffmpeg',
-        '-rtsp_transport', 'tcp',  # Use TCP for better reliability
+        *input_args,
         '-i', rtsp_url,
-        '-c:v', 'libx264',
-        '-preset', 'veryfast',
-        '-tune', 'zerolatency',
-        '-c:a', 'aac',
-        '-b:a', '128k',
+        *video_args,
+        *audio_args,
         '-f', 'hls',
         '-hls_time', '2',  # 2 second segments
         '-hls_list_size', '5',  # Keep 5 segments in playlist
@@ -476,6 +821,10 @@ def start_ffmpeg_stream(rtsp_url, stream_id):
         '-start_number', '0',
         str(playlist_path)
     ]
+
+def start_ffmpeg_stream(rtsp_url, stream_id):
+    """Start FFmpeg process to convert RTSP to HLS"""
+    ffmpeg_cmd = build_ffmpeg_command(rtsp_url, stream_id, get_stream_probe(stream_id))
     
     try:
         print(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
@@ -497,12 +846,7 @@ def start_ffmpeg_stream(rtsp_url, stream_id):
         log_thread = threading.Thread(target=log_output, daemon=True)
         log_thread.start()
         
-        with stream_lock:
-            active_streams[stream_id] = {
-                'process': process,
-                'playlist_path': playlist_path,
-                'started_at': time.time()
-            }
+        register_stream(stream_id, process)
         
         print(f"FFmpeg process started with PID: {process.pid}")
         return process
@@ -512,40 +856,226 @@ def start_ffmpeg_stream(rtsp_url, stream_id):
         traceback.print_exc()
         return None
 
+def register_stream(stream_id, process):
+    """Record a started FFmpeg process in active_streams"""
+    with stream_lock:
+        active_streams[stream_id] = {
+            'process': process,
+            'playlist_path': playlist_path_for(stream_id),
+            'started_at': time.time()
+        }
+    ensure_resource_sampler()
+
 def stop_ffmpeg_stream(stream_id):
     """Stop FFmpeg process for a stream"""
+    # The entry stays in active_streams, marked as stopping, until its files are
+    # gone, so a playlist request meanwhile cannot start a new FFmpeg whose
+    # playlist and segments the cleanup below would then delete
     with stream_lock:
-        if stream_id in active_streams:
-            process = active_streams[stream_id]['process']
-            try:
-                process.terminate()
-                process.wait(timeout=5)
-            except:
-                process.kill()
+        stream = active_streams.get(stream_id)
+        if not stream or stream.get('stopping'):
+            return
+        stream['stopping'] = True
+    
+    # Wait outside the lock: processes started from asgi.py only report their
+    # exit once the event loop runs, and the loop may be waiting for the lock
+    process = stream['process']
+    try:
+        process.terminate()
+        process.wait(timeout=5)
+    except:
+        process.kill()
+    
+    # Clean up HLS files (a bare 'stream_1*' would also match stream 12's)
+    for file in [playlist_path_for(stream_id), *HLS_OUTPUT_DIR.glob(f'stream_{stream_id}_*')]:
+        try:
+            file.unlink()
+        except:
+            pass
+    
+    with stream_lock:
+        if active_streams.get(stream_id) is stream:
             del active_streams[stream_id]
-            
-            # Clean up HLS files
-            for file in HLS_OUTPUT_DIR.glob(f'stream_{stream_id}*'):
-                try:
-                    file.unlink()
-                except:
-                    pass
+
+# Stream Resource Accounting
+# A background thread samples CPU time, RSS and I/O of every FFmpeg process in
+# active_streams from /proc (Linux only) and stores it under 'resources'.
+RESOURCE_SAMPLE_INTERVAL = float(os.getenv('RESOURCE_SAMPLE_INTERVAL', '5'))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+resource_sampler = None
+resource_sampler_lock = threading.Lock()
+
+def read_process_resources(pid):
+    """Read cumulative CPU seconds, RSS and I/O bytes for a process from /proc"""
+    with open(f'/proc/{pid}/stat') as f:
+        stat = f.read()
+    # Fields after the parenthesised command name, starting at field 3 (state)
+    fields = stat[stat.rindex(')') + 2:].split()
+    resources = {
+        'cpu_seconds': (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,  # utime + stime
+        'rss_bytes': int(fields[21]) * PAGE_SIZE
+    }
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        # rchar/wchar count all reads and writes, including the RTSP socket;
+        # the kernel's read_bytes/write_bytes fields count storage I/O only
+        resources['rchar_bytes'] = int(io['rchar'])
+        resources['wchar_bytes'] = int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return resources
+
+def sample_stream_resources():
+    while True:
+        with stream_lock:
+            streams = list(active_streams.values())
+        for stream in streams:
+            process = stream['process']
+            if process.poll() is not None:
+                continue
+            try:
+                sample = read_process_resources(process.pid)
+            except (OSError, ValueError, IndexError):
+                continue
+            sample['sampled_at'] = time.time()
+            previous = stream.get('resources')
+            if previous:
+                elapsed = sample['sampled_at'] - previous['sampled_at']
+                if elapsed > 0:
+                    sample['cpu_percent'] = round(100 * (sample['cpu_seconds'] - previous['cpu_seconds']) / elapsed, 1)
+            stream['resources'] = sample
+        time.sleep(RESOURCE_SAMPLE_INTERVAL)
+
+def ensure_resource_sampler():
+    """Start the sampler on first use, so it runs in the worker process after forking"""
+    global resource_sampler
+    # Streams start from several request threads at once, so start exactly one
+    with resource_sampler_lock:
+        if resource_sampler is None and os.path.isdir('/proc'):
+            resource_sampler = threading.Thread(target=sample_stream_resources, daemon=True, name='stream-resources')
+            resource_sampler.start()
+
+# Request Profiling
+# Opt-in sampling profiler, toggled per endpoint at runtime through
+# /api/admin/profiling. While a profiled request runs, its thread's stack (or,
+# for the asyncio media handlers, the worker thread or await it is in) is
+# sampled and stored as folded stacks ("frame;frame;frame count") ready for
+# flamegraph.pl or speedscope. Samples are rooted at the endpoint name and the
+# stream id, so slow calls can be tied to a specific stream. Settings and samples
+# are per worker process.
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+profiled_endpoints = set()
+profile_samples = {}  # endpoint -> Counter of folded stacks
+# Thread ident -> (endpoint, root frame label, coroutine key). Flask requests
+# register their own thread with key None; asgi.py registers the worker threads
+# its handlers offload to, keyed by the handler coroutine they work for.
+profiled_threads = {}
+# Handlers served from asyncio (asgi.py): key -> (endpoint, label, coroutine,
+# event loop thread ident). While a handler is suspended on an await, its
+# coroutine chain is sampled so wall-clock time waiting is profiled too.
+profiled_coroutines = {}
+profile_lock = threading.Lock()
+profiler = None
+profiler_lock = threading.Lock()
+
+def profile_label(endpoint, stream_id):
+    return f'{endpoint}[stream={stream_id}]' if stream_id is not None else endpoint
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def folded_stack(frame):
+    frames = []
+    while frame is not None:
+        frames.append(frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+def folded_await_chain(coro):
+    """Fold the frames of a suspended coroutine down to what it is awaiting"""
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append(frame_label(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    frames.append('[awaiting]')
+    return ';'.join(frames)
+
+def record_profile_sample(endpoint, label, stack):
+    with profile_lock:
+        profile_samples.setdefault(endpoint, Counter())[f'{label};{stack}'] += 1
+
+def sample_profiled_requests():
+    global profiler
+    while True:
+        # Decide to exit under the lock, so ensure_profiler either sees the
+        # endpoint it just enabled keep this thread going or starts a new one
+        with profiler_lock:
+            if not profiled_endpoints:
+                profiler = None
+                return
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+        frames = sys._current_frames()
+        busy = set()
+        for ident, (endpoint, label, key) in list(profiled_threads.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                record_profile_sample(endpoint, label, folded_stack(frame))
+                busy.add(key)
+        # A handler whose work is in a worker thread was sampled there
+        for key, (endpoint, label, coro, loop_ident) in list(profiled_coroutines.items()):
+            if key in busy:
+                continue
+            if coro.cr_running:
+                frame = frames.get(loop_ident)
+                if frame is not None:
+                    record_profile_sample(endpoint, label, folded_stack(frame))
+            elif coro.cr_frame is not None:
+                record_profile_sample(endpoint, label, folded_await_chain(coro))
+
+def ensure_profiler():
+    global profiler
+    with profiler_lock:
+        if profiler is None:
+            profiler = threading.Thread(target=sample_profiled_requests, daemon=True, name='request-profiler')
+            profiler.start()
+
+@app.before_request
+def start_request_profile():
+    if request.endpoint in profiled_endpoints:
+        label = profile_label(request.endpoint, (request.view_args or {}).get('stream_id'))
+        profiled_threads[threading.get_ident()] = (request.endpoint, label, None)
+
+@app.teardown_request
+def stop_request_profile(exception=None):
+    profiled_threads.pop(threading.get_ident(), None)
 
 @app.route('/api/stream/hls/<int:stream_id>')
 @token_required
 def get_hls_playlist(current_user_id, stream_id):
     """Serve HLS playlist (.m3u8 file)"""
-    settings = StreamSettings.query.filter_by(id=stream_id, user_id=current_user_id).first()
-    if not settings:
+    rtsp_url = get_owned_stream_url(current_user_id, stream_id)
+    if rtsp_url is None:
         return jsonify({'error': 'Stream not found'}), 404
     
-    playlist_path = HLS_OUTPUT_DIR / f'stream_{stream_id}.m3u8'
+    playlist_path = playlist_path_for(stream_id)
+    
+    # Polls of a running stream are cheap and stay unthrottled; only (re)starting
+    # FFmpeg is limited
+    if stream_id not in active_streams:
+        retry_after = take_rate_limit_token('stream_start', current_user_id)
+        if retry_after > 0:
+            return rate_limit_response(retry_after)
     
     # Check if stream is already running
     with stream_lock:
         if stream_id not in active_streams:
             # Start FFmpeg conversion
-            rtsp_url = settings.rtsp_url
             if not rtsp_url.startswith('rtsp://'):
                 return jsonify({'error': 'Invalid RTSP URL'}), 400
             
@@ -566,28 +1096,10 @@ def get_hls_playlist(current_user_id, stream_id):
             with open(playlist_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            # Fix segment URLs to use absolute paths
-            lines = content.split('\n')
-            fixed_lines = []
-            for line in lines:
-                if line.endswith('.ts') and not line.startswith('http'):
-                    # Make segment URL absolute
-                    fixed_lines.append(f'/api/stream/hls/{stream_id}/{line}')
-                else:
-                    fixed_lines.append(line)
-            
-            fixed_content = '\n'.join(fixed_lines)
-            
             return Response(
-                fixed_content,
+                rewrite_playlist(content, stream_id),
                 mimetype='application/vnd.apple.mpegurl',
-                headers={
-                    'Cache-Control': 'no-cache, no-store, must-revalidate',
-                    'Pragma': 'no-cache',
-                    'Expires': '0',
-                    'Access-Control-Allow-Origin': '*',
-                    'Content-Type': 'application/vnd.apple.mpegurl'
-                }
+                headers=PLAYLIST_HEADERS
             )
         except Exception as e:
             print(f"Error reading playlist: {e}")
@@ -614,21 +1126,15 @@ def get_hls_playlist(current_user_id, stream_id):
 def get_hls_segment(current_user_id, stream_id, filename):
     """Serve HLS segment files (.ts files)"""
     # Verify stream belongs to user
-    settings = StreamSettings.query.filter_by(id=stream_id, user_id=current_user_id).first()
-    if not settings:
+    if get_owned_stream_url(current_user_id, stream_id) is None:
         return jsonify({'error': 'Stream not found'}), 404
     
-    segment_path = HLS_OUTPUT_DIR / filename
+    segment_path = segment_path_for(stream_id, filename)
     
-    if segment_path.exists():
-        return send_file(
-            segment_path,
-            mimetype='video/mp2t',
-            headers={
-                'Access-Control-Allow-Origin': '*',
-                'Cache-Control': 'public, max-age=3600'
-            }
-        )
+    if segment_path and segment_path.exists():
+        response = send_file(segment_path, mimetype='video/mp2t')
+        response.headers.update(SEGMENT_HEADERS)
+        return response
     else:
         return jsonify({'error': 'Segment not found'}), 404
 
@@ -637,8 +1143,7 @@ def get_hls_segment(current_user_id, stream_id, filename):
 def stop_stream(current_user_id, stream_id):
     """Stop an active stream"""
     # Verify stream belongs to user
-    settings = StreamSettings.query.filter_by(id=stream_id, user_id=current_user_id).first()
-    if not settings:
+    if get_owned_stream_url(current_user_id, stream_id) is None:
         return jsonify({'error': 'Stream not found'}), 404
     
     stop_ffmpeg_stream(stream_id)
@@ -649,8 +1154,7 @@ def stop_stream(current_user_id, stream_id):
 def get_stream_status(current_user_id, stream_id):
     """Get status of a stream"""
     # Verify stream belongs to user
-    settings = StreamSettings.query.filter_by(id=stream_id, user_id=current_user_id).first()
-    if not settings:
+    if get_owned_stream_url(current_user_id, stream_id) is None:
         return jsonify({'error': 'Stream not found'}), 404
     
     with stream_lock:
@@ -659,9 +1163,65 @@ def get_stream_status(current_user_id, stream_id):
             is_running = process.poll() is None
             return jsonify({
                 'running': is_running,
-                'started_at': active_streams[stream_id]['started_at']
+                'started_at': active_streams[stream_id]['started_at'],
+                'resources': active_streams[stream_id].get('resources')
             })
         return jsonify({'running': False}), 200
 
+# Admin Routes
+@app.route('/api/admin/streams', methods=['GET'])
+@admin_required
+def get_active_streams():
+    """Resource usage of every active stream in this worker"""
+    with stream_lock:
+        streams = list(active_streams.items())
+    return jsonify([{
+        'stream_id': stream_id,
+        'pid': stream['process'].pid,
+        'running': stream['process'].poll() is None,
+        'started_at': stream['started_at'],
+        'resources': stream.get('resources')
+    } for stream_id, stream in streams])
+
+@app.route('/api/admin/profiling', methods=['GET'])
+@admin_required
+def get_profiling():
+    """List profiled endpoints and how many samples each has collected"""
+    with profile_lock:
+        counts = {endpoint: sum(samples.values()) for endpoint, samples in profile_samples.items()}
+    return jsonify({
+        'enabled': sorted(profiled_endpoints),
+        'samples': counts,
+        'interval': PROFILE_SAMPLE_INTERVAL
+    })
+
+@app.route('/api/admin/profiling', methods=['POST'])
+@admin_required
+def update_profiling():
+    """Turn profiling on or off for an endpoint, e.g. {"endpoint": "get_hls_playlist", "enabled": true}"""
+    data = request.get_json(silent=True) or {}
+    endpoint = data.get('endpoint')
+    if endpoint not in app.view_functions:
+        return jsonify({'error': 'Unknown endpoint'}), 400
+    
+    if data.get('enabled', True):
+        profiled_endpoints.add(endpoint)
+        ensure_profiler()
+    else:
+        profiled_endpoints.discard(endpoint)
+    return jsonify({'enabled': sorted(profiled_endpoints)})
+
+@app.route('/api/admin/profiling/<endpoint>', methods=['GET'])
+@admin_required
+def get_profile_stacks(endpoint):
+    """Folded stacks for an endpoint; ?reset=1 clears them after reading"""
+    with profile_lock:
+        if request.args.get('reset'):
+            samples = profile_samples.pop(endpoint, Counter())
+        else:
+            samples = Counter(profile_samples.get(endpoint, Counter()))
+    folded = '\n'.join(f'{stack} {count}' for stack, count in samples.most_common())
+    return Response(folded + '\n' if folded else '', mimetype='text/plain')
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
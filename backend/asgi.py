@@ -0,0 +1,407 @@
+"""
+ASGI entry point.
+
+The HLS media routes (playlist, segments, stream status) are served directly
+from asyncio so that thousands of viewers polling playlists and downloading
+segments do not each hold a worker thread. Every other request is handed to
+the Flask app, which keeps serving the CRUD and auth API.
+
+Run with:
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+"""
+import asyncio
+import contextvars
+import json
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+
+from app import (
+    app,
+    active_streams,
+    parse_auth_header,
+    cached_stream_url,
+    get_owned_stream_url,
+    get_stream_probe,
+    playlist_path_for,
+    segment_path_for,
+    rewrite_playlist,
+    build_ffmpeg_command,
+    take_rate_limit_token,
+    FLASK_WORKERS,
+    register_stream,
+    profiled_endpoints,
+    profiled_threads,
+    profiled_coroutines,
+    profile_label,
+    rate_limit_backend,
+    MemoryBucketBackend,
+    PLAYLIST_HEADERS,
+    SEGMENT_HEADERS,
+)
+
+# How long a playlist request waits for FFmpeg to write the first playlist
+PLAYLIST_WAIT_TIMEOUT = float(os.getenv('PLAYLIST_WAIT_TIMEOUT', '5'))
+# Large enough that a typical 2-second segment is sent in one or two reads
+SEGMENT_CHUNK_SIZE = 1024 * 1024
+# Playlist and segment reads get their own threads so they never queue behind
+# database lookups (or each other) on asyncio's small default executor
+MEDIA_IO_WORKERS = int(os.getenv('MEDIA_IO_WORKERS', '32'))
+media_io_executor = ThreadPoolExecutor(max_workers=MEDIA_IO_WORKERS, thread_name_prefix='media-io')
+
+flask_application = WSGIMiddleware(app, workers=FLASK_WORKERS)
+
+PLAYLIST_ROUTE = re.compile(r'^/api/stream/hls/(\d+)$')
+SEGMENT_ROUTE = re.compile(r'^/api/stream/hls/(\d+)/([^/]+)$')
+STATUS_ROUTE = re.compile(r'^/api/stream/status/(\d+)$')
+
+# One lock per stream so concurrent first viewers start FFmpeg only once
+start_locks = defaultdict(asyncio.Lock)
+
+# (endpoint, label, key) of the profiled handler running in this task, if any
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+class AsyncFFmpegProcess:
+    """Popen-compatible view of an asyncio subprocess.
+
+    Streams started here are stored in active_streams like any other, so the
+    Flask routes (stop, status) can manage them from their worker threads.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+        self.stderr = None
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def poll(self):
+        return self.process.returncode
+
+    def send_signal(self, sig):
+        if self.process.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                # Exited and reaped before the event loop recorded it
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+
+    def wait(self, timeout=None):
+        # Only called from worker threads; the event loop records the exit
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.process.returncode is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(self.pid, timeout)
+            time.sleep(0.05)
+        return self.process.returncode
+
+
+def profiled_call(func, *args):
+    # Runs in the worker thread; the handler's profile travels in the copied context
+    profile = current_profile.get()
+    if profile is None:
+        return func(*args)
+    ident = threading.get_ident()
+    profiled_threads[ident] = profile
+    try:
+        return func(*args)
+    finally:
+        profiled_threads.pop(ident, None)
+
+
+async def to_thread(func, *args, executor=None):
+    """Run func in a worker thread (the default executor unless given), profiled for the calling handler"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, context.run, profiled_call, func, *args)
+
+
+async def read_media(func, *args):
+    return await to_thread(func, *args, executor=media_io_executor)
+
+
+async def run_in_app_context(func, *args):
+    """Run a blocking function that needs the database in a worker thread"""
+    def call():
+        with app.app_context():
+            return func(*args)
+    return await to_thread(call)
+
+
+async def owned_stream_url(user_id, stream_id):
+    # A cache hit is a dict read; only a miss needs a thread and the database
+    rtsp_url = cached_stream_url(user_id, stream_id)
+    if rtsp_url is not None:
+        return rtsp_url
+    return await run_in_app_context(get_owned_stream_url, user_id, stream_id)
+
+
+async def take_token(route_class, key):
+    # The in-process buckets never block; a shared backend does network I/O
+    if isinstance(rate_limit_backend, MemoryBucketBackend):
+        return take_rate_limit_token(route_class, key)
+    return await to_thread(take_rate_limit_token, route_class, key)
+
+
+async def log_ffmpeg_output(process):
+    async for line in process.stderr:
+        print(f"FFmpeg: {line.decode(errors='replace').strip()}")
+
+
+async def start_ffmpeg_stream_async(rtsp_url, stream_id):
+    """Start FFmpeg process to convert RTSP to HLS without blocking the event loop"""
+    probe = await run_in_app_context(get_stream_probe, stream_id)
+    ffmpeg_cmd = build_ffmpeg_command(rtsp_url, stream_id, probe)
+
+    try:
+        print(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL,
+            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+        )
+    except Exception as e:
+        print(f"Error starting FFmpeg: {e}")
+        return None
+
+    asyncio.create_task(log_ffmpeg_output(process))
+    wrapped = AsyncFFmpegProcess(process)
+
+    # stream_lock is a thread lock that a Flask thread may hold for a while, so
+    # never take it on the event loop
+    await to_thread(register_stream, stream_id, wrapped)
+
+    print(f"FFmpeg process started with PID: {process.pid}")
+    return wrapped
+
+
+async def wait_for_playlist(playlist_path, process):
+    """Wait until FFmpeg writes the playlist, it exits, or the timeout passes"""
+    deadline = time.monotonic() + PLAYLIST_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        if playlist_path.exists() or process.poll() is not None:
+            return
+        await asyncio.sleep(0.25)
+
+
+def read_text(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+async def send_response(send, status, body=b'', headers=None, head_only=False):
+    raw_headers = [(b'content-length', str(len(body)).encode())]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), str(value).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': b'' if head_only else body})
+
+
+async def send_json(send, status, data, headers=None, head_only=False):
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        **(headers or {})
+    }
+    await send_response(send, status, json.dumps(data).encode(), headers, head_only)
+
+
+async def send_rate_limited(send, retry_after, head_only):
+    await send_json(
+        send, 429, {'error': 'Too many requests, please slow down'},
+        {'Retry-After': str(max(1, int(retry_after + 0.999)))}, head_only
+    )
+
+
+async def serve_playlist(send, user_id, stream_id, head_only):
+    """Serve HLS playlist (.m3u8 file), starting FFmpeg on first request"""
+    rtsp_url = await owned_stream_url(user_id, stream_id)
+    if rtsp_url is None:
+        return await send_json(send, 404, {'error': 'Stream not found'}, head_only=head_only)
+
+    playlist_path = playlist_path_for(stream_id)
+
+    # Polls of a running stream are cheap and stay unthrottled; only (re)starting
+    # FFmpeg is limited
+    if stream_id not in active_streams:
+        retry_after = await take_token('stream_start', user_id)
+        if retry_after > 0:
+            return await send_rate_limited(send, retry_after, head_only)
+
+        async with start_locks[stream_id]:
+            if stream_id not in active_streams:
+                if not rtsp_url.startswith('rtsp://'):
+                    return await send_json(send, 400, {'error': 'Invalid RTSP URL'}, head_only=head_only)
+
+                print(f"Starting FFmpeg conversion for RTSP: {rtsp_url}")
+                process = await start_ffmpeg_stream_async(rtsp_url, stream_id)
+                if not process:
+                    print("Failed to start FFmpeg process")
+                    return await send_json(
+                        send, 500, {'error': 'Failed to start stream conversion'}, head_only=head_only
+                    )
+
+                print("Waiting for first HLS segment...")
+                await wait_for_playlist(playlist_path, process)
+
+    try:
+        content = await read_media(read_text, playlist_path)
+    except FileNotFoundError:
+        stream = active_streams.get(stream_id)
+        if stream and stream['process'].poll() is not None:
+            print(f"FFmpeg process exited with code: {stream['process'].returncode}")
+        return await send_json(
+            send, 503, {'error': 'Playlist not ready yet. Please wait a few seconds and try again.'},
+            head_only=head_only
+        )
+    except Exception as e:
+        print(f"Error reading playlist: {e}")
+        return await send_json(send, 500, {'error': f'Error reading playlist: {str(e)}'}, head_only=head_only)
+
+    body = rewrite_playlist(content, stream_id).encode('utf-8')
+    await send_response(send, 200, body, PLAYLIST_HEADERS, head_only)
+
+
+async def serve_segment(send, user_id, stream_id, filename, head_only):
+    """Serve HLS segment files (.ts files) in chunks read off the event loop"""
+    if await owned_stream_url(user_id, stream_id) is None:
+        return await send_json(send, 404, {'error': 'Stream not found'}, head_only=head_only)
+
+    segment_path = segment_path_for(stream_id, filename)
+    try:
+        # Segments may be deleted by FFmpeg at any moment, so open before stat
+        segment_file = await read_media(open, segment_path, 'rb') if segment_path else None
+    except OSError:
+        segment_file = None
+    if segment_file is None:
+        return await send_json(send, 404, {'error': 'Segment not found'}, head_only=head_only)
+
+    try:
+        size = (await read_media(os.fstat, segment_file.fileno())).st_size
+        headers = [
+            (b'content-type', b'video/mp2t'),
+            (b'content-length', str(size).encode()),
+        ] + [(name.lower().encode(), value.encode()) for name, value in SEGMENT_HEADERS.items()]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+        if head_only:
+            return await send({'type': 'http.response.body', 'body': b''})
+
+        while True:
+            chunk = await read_media(segment_file.read, SEGMENT_CHUNK_SIZE)
+            more_body = len(chunk) == SEGMENT_CHUNK_SIZE
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+            if not more_body:
+                break
+    finally:
+        segment_file.close()
+
+
+async def serve_status(send, user_id, stream_id, head_only):
+    """Get status of a stream"""
+    if await owned_stream_url(user_id, stream_id) is None:
+        return await send_json(send, 404, {'error': 'Stream not found'}, head_only=head_only)
+
+    stream = active_streams.get(stream_id)
+    if stream:
+        return await send_json(send, 200, {
+            'running': stream['process'].poll() is None,
+            'started_at': stream['started_at'],
+            'resources': stream.get('resources')
+        }, head_only=head_only)
+    await send_json(send, 200, {'running': False}, head_only=head_only)
+
+
+# Profiled under the same endpoint names as their Flask counterparts
+HANDLER_ENDPOINTS = {
+    serve_playlist: 'get_hls_playlist',
+    serve_segment: 'get_hls_segment',
+    serve_status: 'get_stream_status',
+}
+
+
+async def run_handler(handler, *args):
+    endpoint = HANDLER_ENDPOINTS[handler]
+    if endpoint not in profiled_endpoints:
+        return await handler(*args)
+
+    # args are (send, user_id, stream_id, ...)
+    key = object()
+    profile = (endpoint, profile_label(endpoint, args[2]), key)
+    token = current_profile.set(profile)
+    coro = handler(*args)
+    profiled_coroutines[key] = (*profile[:2], coro, threading.get_ident())
+    try:
+        return await coro
+    finally:
+        profiled_coroutines.pop(key, None)
+        current_profile.reset(token)
+
+
+def match_media_route(path):
+    """Return (handler, args) for the routes served from asyncio, or None"""
+    match = PLAYLIST_ROUTE.match(path)
+    if match:
+        return serve_playlist, (int(match.group(1)),)
+    match = SEGMENT_ROUTE.match(path)
+    if match:
+        return serve_segment, (int(match.group(1)), match.group(2))
+    match = STATUS_ROUTE.match(path)
+    if match:
+        return serve_status, (int(match.group(1)),)
+    return None
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    # CORS preflight and everything that is not a media read goes to Flask
+    route = None
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        route = match_media_route(scope['path'])
+    if route is None:
+        return await flask_application(scope, receive, send)
+
+    handler, args = route
+    head_only = scope['method'] == 'HEAD'
+    headers = dict(scope['headers'])
+    auth_header = headers.get(b'authorization')
+    user_id, error = parse_auth_header(auth_header.decode('latin-1') if auth_header is not None else None)
+    if error:
+        return await send_json(send, 401, {'error': error}, head_only=head_only)
+
+    await run_handler(handler, send, user_id, *args, head_only)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi:application', host='0.0.0.0', port=5000)
@@ -1,123 +1,429 @@
 """
-Database migration script to add user_id columns to existing tables.
-Run this once after updating to the authentication version.
+Versioned, resumable database migrations.
+
+Migrations are applied in order and their progress is recorded in the
+schema_migrations table, so an interrupted run picks up where it stopped.
+They are written so they do not block live traffic on large tables:
+
+- rows are deleted in bounded batches, each in its own transaction
+- indexes are built CONCURRENTLY (invalid leftovers from a failed build are rebuilt)
+- constraints are added NOT VALID and validated afterwards, which only takes a
+  lock that allows reads and writes
+- DDL runs with a short lock_timeout so it fails fast instead of queueing
+  behind long transactions
+
+Usage:
+    python migrate_db.py                # apply pending migrations
+    python migrate_db.py --dry-run      # list pending steps with timing estimates
+    python migrate_db.py --max-seconds 60
+
+The same runner backs the /api/migrate endpoint in app.py.
 """
-from app import app, db, User, Overlay, StreamSettings
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
 from sqlalchemy import text
 
-def migrate_database():
-    with app.app_context():
-        print("Starting database migration...")
-        
-        # Create users table if it doesn't exist
-        db.create_all()
-        print("[OK] Users table created/verified")
-        
-        # Check if user_id column exists in overlays table
-        try:
-            result = db.session.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='overlays' AND column_name='user_id'
-            """))
-            overlay_has_user_id = result.fetchone() is not None
-        except:
-            overlay_has_user_id = False
-        
-        # Check if user_id column exists in stream_settings table
-        try:
-            result = db.session.execute(text("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='stream_settings' AND column_name='user_id'
-            """))
-            settings_has_user_id = result.fetchone() is not None
-        except:
-            settings_has_user_id = False
-        
-        # Add user_id to overlays if it doesn't exist
-        if not overlay_has_user_id:
-            print("Adding user_id column to overlays table...")
-            try:
-                db.session.execute(text("""
-                    ALTER TABLE overlays 
-                    ADD COLUMN user_id INTEGER REFERENCES users(id)
-                """))
-                db.session.commit()
-                print("[OK] Added user_id to overlays table")
-            except Exception as e:
-                print(f"Error adding user_id to overlays: {e}")
-                db.session.rollback()
-        else:
-            print("[OK] overlays table already has user_id column")
-        
-        # Add user_id to stream_settings if it doesn't exist
-        if not settings_has_user_id:
-            print("Adding user_id column to stream_settings table...")
-            try:
-                # First add as nullable
-                db.session.execute(text("""
-                    ALTER TABLE stream_settings 
-                    ADD COLUMN user_id INTEGER REFERENCES users(id)
-                """))
-                db.session.commit()
-                print("[OK] Added user_id to stream_settings table")
-                
-                # Delete existing stream_settings that don't have user_id
-                # (they won't work with the new auth system anyway)
-                db.session.execute(text("""
-                    DELETE FROM stream_settings WHERE user_id IS NULL
-                """))
-                db.session.commit()
-                print("[OK] Cleaned up orphaned stream_settings")
-                
-                # Now make it NOT NULL and UNIQUE
-                db.session.execute(text("""
-                    ALTER TABLE stream_settings 
-                    ALTER COLUMN user_id SET NOT NULL
-                """))
-                db.session.execute(text("""
-                    ALTER TABLE stream_settings 
-                    ADD CONSTRAINT stream_settings_user_id_unique UNIQUE (user_id)
-                """))
-                db.session.commit()
-                print("[OK] Made user_id NOT NULL and UNIQUE in stream_settings")
-            except Exception as e:
-                print(f"Error adding user_id to stream_settings: {e}")
-                db.session.rollback()
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '5000'))
+# Pause between delete batches so replication and live traffic can keep up
+MIGRATION_BATCH_PAUSE = float(os.getenv('MIGRATION_BATCH_PAUSE', '0.05'))
+MIGRATION_LOCK_TIMEOUT = os.getenv('MIGRATION_LOCK_TIMEOUT', '5s')
+# Arbitrary application-wide key for the advisory lock held during a run
+MIGRATION_ADVISORY_LOCK = 72130561
+
+# Rough throughput figures used for dry-run estimates
+ESTIMATED_DELETE_ROWS_PER_SECOND = 20000
+ESTIMATED_SCAN_ROWS_PER_SECOND = 500000
+ESTIMATED_INDEX_ROWS_PER_SECOND = 200000
+
+
+class MigrationPaused(Exception):
+    """Raised when a run reaches its time budget; the next run resumes"""
+
+
+class MigrationContext:
+    def __init__(self, db, conn, max_seconds=None, log=print):
+        self.db = db
+        self.conn = conn
+        self.deadline = time.monotonic() + max_seconds if max_seconds else None
+        self.log = log
+        self.checkpoint = {}
+        self.save_checkpoint = lambda: None
+
+    def execute(self, sql, **params):
+        return self.conn.execute(text(sql), params)
+
+    def scalar(self, sql, **params):
+        return self.execute(sql, **params).scalar()
+
+    def check_time(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise MigrationPaused()
+
+    def table_rows(self, table):
+        """Planner row estimate for a table, counted if it was never analyzed"""
+        rows = self.scalar("SELECT reltuples FROM pg_class WHERE relname = :table", table=table)
+        if rows is None or rows < 0:
+            rows = self.scalar(f"SELECT count(*) FROM {table}")
+        return int(rows)
+
+    def column_exists(self, table, column):
+        return self.scalar("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = :table AND column_name = :column
+        """, table=table, column=column) is not None
+
+    def constraint_exists(self, name):
+        return self.scalar("SELECT 1 FROM pg_constraint WHERE conname = :name", name=name) is not None
+
+
+# Migration steps
+# Each step is idempotent: re-running a step that already (partly) ran is safe,
+# which is what makes resuming after an interruption possible.
+
+class CreateTables:
+    def describe(self):
+        return 'Create missing tables'
+
+    def apply(self, ctx):
+        ctx.db.metadata.create_all(bind=ctx.conn)
+
+    def estimate(self, ctx):
+        return 0
+
+
+class AddColumn:
+    def __init__(self, table, column, column_type):
+        self.table = table
+        self.column = column
+        self.column_type = column_type
+
+    def describe(self):
+        return f'Add {self.table}.{self.column}'
+
+    def apply(self, ctx):
+        # Nullable and without a default, so this only touches the catalog
+        ctx.execute(f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS {self.column} {self.column_type}")
+
+    def estimate(self, ctx):
+        return 0
+
+
+class CreateIndex:
+    def __init__(self, name, table, column, unique=False):
+        self.name = name
+        self.table = table
+        self.column = column
+        self.unique = unique
+
+    def describe(self):
+        return f"Build {'unique ' if self.unique else ''}index {self.name} concurrently"
+
+    def apply(self, ctx):
+        valid = ctx.scalar("""
+            SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = :name
+        """, name=self.name)
+        if valid is False:
+            # Left behind by an interrupted concurrent build
+            ctx.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {self.name}")
+        ctx.execute(
+            f"CREATE {'UNIQUE ' if self.unique else ''}INDEX CONCURRENTLY IF NOT EXISTS "
+            f"{self.name} ON {self.table} ({self.column})"
+        )
+
+    def estimate(self, ctx):
+        # Concurrent builds scan the table twice
+        return 2 * ctx.table_rows(self.table) / ESTIMATED_INDEX_ROWS_PER_SECOND
+
+
+class DeleteNullsInBatches:
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        self.where = f'{column} IS NULL'
+
+    def describe(self):
+        return f'Delete {self.table} rows where {self.where}'
+
+    def apply(self, ctx):
+        key = f'deleted_{self.table}'
+        while True:
+            ctx.check_time()
+            result = ctx.execute(f"""
+                DELETE FROM {self.table} WHERE id IN (
+                    SELECT id FROM {self.table} WHERE {self.where} LIMIT :batch_size
+                )
+            """, batch_size=MIGRATION_BATCH_SIZE)
+            if result.rowcount:
+                ctx.checkpoint[key] = ctx.checkpoint.get(key, 0) + result.rowcount
+                ctx.save_checkpoint()
+            if result.rowcount < MIGRATION_BATCH_SIZE:
+                break
+            time.sleep(MIGRATION_BATCH_PAUSE)
+        if ctx.checkpoint.get(key):
+            ctx.log(f"Deleted {ctx.checkpoint[key]} {self.table} rows where {self.where}")
+
+    def estimate(self, ctx):
+        if ctx.column_exists(self.table, self.column):
+            rows = ctx.scalar(f"SELECT count(*) FROM {self.table} WHERE {self.where}")
         else:
-            print("[OK] stream_settings table already has user_id column")
-        
-        # Clean up overlays without user_id
+            # Added by an earlier migration, so every existing row will be NULL
+            rows = ctx.table_rows(self.table)
+        batches = rows // MIGRATION_BATCH_SIZE + 1
+        return rows / ESTIMATED_DELETE_ROWS_PER_SECOND + batches * MIGRATION_BATCH_PAUSE
+
+
+class AddForeignKey:
+    def __init__(self, name, table, column, ref_table):
+        self.name = name
+        self.table = table
+        self.column = column
+        self.ref_table = ref_table
+
+    def describe(self):
+        return f'Add and validate foreign key {self.name}'
+
+    def apply(self, ctx):
+        if not ctx.constraint_exists(self.name):
+            ctx.execute(f"""
+                ALTER TABLE {self.table} ADD CONSTRAINT {self.name}
+                FOREIGN KEY ({self.column}) REFERENCES {self.ref_table}(id) NOT VALID
+            """)
+        ctx.execute(f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {self.name}")
+
+    def estimate(self, ctx):
+        return ctx.table_rows(self.table) / ESTIMATED_SCAN_ROWS_PER_SECOND
+
+
+class SetNotNull:
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        self.check_name = f'{table}_{column}_not_null'
+
+    def describe(self):
+        return f'Make {self.table}.{self.column} NOT NULL'
+
+    def apply(self, ctx):
+        is_nullable = ctx.scalar("""
+            SELECT is_nullable FROM information_schema.columns
+            WHERE table_name = :table AND column_name = :column
+        """, table=self.table, column=self.column)
+        if is_nullable == 'YES':
+            # A validated CHECK lets SET NOT NULL skip its full-table scan
+            if not ctx.constraint_exists(self.check_name):
+                ctx.execute(f"""
+                    ALTER TABLE {self.table} ADD CONSTRAINT {self.check_name}
+                    CHECK ({self.column} IS NOT NULL) NOT VALID
+                """)
+            ctx.execute(f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {self.check_name}")
+            ctx.execute(f"ALTER TABLE {self.table} ALTER COLUMN {self.column} SET NOT NULL")
+        ctx.execute(f"ALTER TABLE {self.table} DROP CONSTRAINT IF EXISTS {self.check_name}")
+
+    def estimate(self, ctx):
+        return ctx.table_rows(self.table) / ESTIMATED_SCAN_ROWS_PER_SECOND
+
+
+# Migrations, applied in order. Never edit or reorder an applied migration;
+# add a new one instead.
+MIGRATIONS = [
+    ('001_create_tables', [
+        CreateTables(),
+    ]),
+    ('002_user_id_columns', [
+        AddColumn('overlays', 'user_id', 'INTEGER'),
+        AddColumn('stream_settings', 'user_id', 'INTEGER'),
+    ]),
+    ('003_user_id_indexes', [
+        CreateIndex('ix_overlays_user_id', 'overlays', 'user_id'),
+        CreateIndex('ix_stream_settings_user_id', 'stream_settings', 'user_id', unique=True),
+    ]),
+    ('004_delete_orphans', [
+        # Rows without an owner are inaccessible under authentication
+        DeleteNullsInBatches('stream_settings', 'user_id'),
+        DeleteNullsInBatches('overlays', 'user_id'),
+    ]),
+    ('005_user_id_constraints', [
+        AddForeignKey('overlays_user_id_fkey', 'overlays', 'user_id', 'users'),
+        AddForeignKey('stream_settings_user_id_fkey', 'stream_settings', 'user_id', 'users'),
+        SetNotNull('overlays', 'user_id'),
+        SetNotNull('stream_settings', 'user_id'),
+    ]),
+    ('006_stream_source_probe', [
+        AddColumn('stream_settings', 'source_probe', 'JSON'),
+    ]),
+]
+
+
+def ensure_migrations_table(ctx):
+    ctx.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(100) PRIMARY KEY,
+            status VARCHAR(20) NOT NULL,
+            checkpoint TEXT,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+
+
+def load_progress(ctx):
+    """Return {version: (status, checkpoint)} for recorded migrations"""
+    rows = ctx.execute("SELECT version, status, checkpoint FROM schema_migrations").fetchall()
+    return {row[0]: (row[1], json.loads(row[2] or '{}')) for row in rows}
+
+
+def record_progress(ctx, version, status, checkpoint):
+    ctx.execute("""
+        INSERT INTO schema_migrations (version, status, checkpoint, started_at, finished_at)
+        VALUES (:version, :status, :checkpoint, :now, :finished_at)
+        ON CONFLICT (version) DO UPDATE SET
+            status = EXCLUDED.status,
+            checkpoint = EXCLUDED.checkpoint,
+            finished_at = EXCLUDED.finished_at
+    """, version=version, status=status, checkpoint=json.dumps(checkpoint),
+        now=datetime.utcnow(), finished_at=datetime.utcnow() if status == 'done' else None)
+
+
+def migrations_table_exists(ctx):
+    return ctx.scalar("SELECT to_regclass('schema_migrations')") is not None
+
+
+def apply_migrations(ctx, progress, results, dry_run, log):
+    """Apply (or, for a dry run, estimate) every migration not yet done"""
+    for version, steps in MIGRATIONS:
+        status, checkpoint = progress.get(version, ('pending', {}))
+        if status == 'done':
+            continue
+        start_step = checkpoint.get('step', 0)
+
+        if dry_run:
+            for step in steps[start_step:]:
+                try:
+                    seconds = round(step.estimate(ctx), 2)
+                except Exception as e:
+                    log(f"Could not estimate {step.describe()}: {e}")
+                    seconds = None
+                results['pending'].append({
+                    'version': version,
+                    'step': step.describe(),
+                    'estimated_seconds': seconds
+                })
+                results['estimated_seconds'] += seconds or 0
+            continue
+
+        ctx.checkpoint = checkpoint
+        ctx.save_checkpoint = lambda: record_progress(ctx, version, 'running', ctx.checkpoint)
+        if start_step:
+            log(f"Resuming {version} at step {start_step + 1}")
         try:
-            result = db.session.execute(text("""
-                DELETE FROM overlays WHERE user_id IS NULL
-            """))
-            db.session.commit()
-            deleted_count = result.rowcount
-            if deleted_count > 0:
-                print(f"[OK] Cleaned up {deleted_count} orphaned overlays")
+            for index in range(start_step, len(steps)):
+                ctx.check_time()
+                steps[index].apply(ctx)
+                ctx.log(f"{version}: {steps[index].describe()}")
+                checkpoint['step'] = index + 1
+                ctx.save_checkpoint()
+            record_progress(ctx, version, 'done', checkpoint)
+        except MigrationPaused:
+            results['complete'] = False
+            ctx.log(f"Paused in {version} after the time budget; run again to resume")
+            return
         except Exception as e:
-            print(f"Note: Could not clean up overlays: {e}")
-        
-        # Make user_id NOT NULL in overlays if it's nullable
+            results['success'] = False
+            results['complete'] = False
+            results['errors'].append(f"{version} failed: {str(e)}")
+            log(f"Error in {version}: {e}")
+            return
+
+
+def run_migrations(db, dry_run=False, max_seconds=None, log=print):
+    """Apply pending migrations, or estimate them when dry_run is set.
+
+    Returns a dict with 'success', 'complete', 'steps' and 'errors'; dry runs
+    also include 'pending' steps and 'estimated_seconds'. When max_seconds is
+    reached the run stops between batches with complete=False, and the next
+    run resumes from the recorded checkpoint. If another run holds the
+    migration lock, nothing is done and 'already_running' is set.
+    A dry run changes nothing, not even the schema_migrations table.
+    """
+    results = {
+        'success': True,
+        'complete': True,
+        'steps': [],
+        'errors': []
+    }
+    if dry_run:
+        results['pending'] = []
+        results['estimated_seconds'] = 0
+
+    def step_log(message):
+        results['steps'].append(message)
+        log(f"[OK] {message}")
+
+    # Autocommit: every statement and delete batch is its own short transaction,
+    # and CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        ctx = MigrationContext(db, conn, max_seconds=max_seconds, log=step_log)
+
+        if dry_run:
+            progress = load_progress(ctx) if migrations_table_exists(ctx) else {}
+            apply_migrations(ctx, progress, results, dry_run, log)
+            results['estimated_seconds'] = round(results['estimated_seconds'], 2)
+            return results
+
+        # Only one run at a time: a concurrent run would, for example, see the
+        # other's in-progress index build as invalid and drop it
+        if not ctx.scalar("SELECT pg_try_advisory_lock(:key)", key=MIGRATION_ADVISORY_LOCK):
+            results['success'] = False
+            results['complete'] = False
+            results['already_running'] = True
+            results['errors'].append('Another migration run is in progress; try again when it finishes')
+            return results
+
         try:
-            db.session.execute(text("""
-                ALTER TABLE overlays 
-                ALTER COLUMN user_id SET NOT NULL
-            """))
-            db.session.commit()
-            print("[OK] Made user_id NOT NULL in overlays")
-        except Exception as e:
-            # Column might already be NOT NULL or have NULL values
-            print(f"Note: Could not set user_id to NOT NULL in overlays: {e}")
-            db.session.rollback()
-        
+            ctx.execute(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+            ensure_migrations_table(ctx)
+            apply_migrations(ctx, load_progress(ctx), results, dry_run, log)
+        finally:
+            # Session-level settings and lock: pooled connections outlive this
+            # run, and app queries must not inherit the DDL lock timeout
+            ctx.execute("RESET lock_timeout")
+            ctx.execute("SELECT pg_advisory_unlock(:key)", key=MIGRATION_ADVISORY_LOCK)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply pending database migrations')
+    parser.add_argument('--dry-run', action='store_true', help='list pending steps with timing estimates')
+    parser.add_argument('--max-seconds', type=float, help='stop after this long; the next run resumes')
+    args = parser.parse_args()
+
+    from app import app, db
+
+    with app.app_context():
+        print("Starting database migration...")
+        results = run_migrations(db, dry_run=args.dry_run, max_seconds=args.max_seconds)
+
+    if args.dry_run:
+        for step in results['pending']:
+            seconds = step['estimated_seconds']
+            estimate = f"~{seconds:g}s" if seconds is not None else "unknown"
+            print(f"  {step['version']}: {step['step']} ({estimate})")
+        print(f"\nEstimated total: ~{results['estimated_seconds']:g}s")
+    elif results.get('already_running'):
+        print("\n[SKIPPED] Another migration run is in progress")
+    elif not results['success']:
+        print("\n[FAILED] Database migration stopped; fix the error and run again to resume")
+    elif not results['complete']:
+        print("\n[PAUSED] Run again to continue the migration")
+    else:
         print("\n[SUCCESS] Database migration completed!")
-        print("\nNext steps:")
-        print("1. Restart your backend server")
-        print("2. Register a new user account")
-        print("3. Start using the application")
+
 
 if __name__ == '__main__':
-    migrate_database()
+    main()
@@ -142,7 +142,7 @@ function App() {
       setShowSettings(false);
     } catch (error) {
       console.error('Error updating stream settings:', error);
-      alert('Failed to update stream settings');
+      alert(error.response?.data?.error || 'Failed to update stream settings');
     }
   };
 